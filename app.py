@@ -1,115 +1,413 @@
 # pdf_translate_deep.py
-import time
+import argparse
+import asyncio
+import functools
+import hashlib
 import math
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import multiprocessing
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
 
+import httpx
 import fitz  # PyMuPDF
-from deep_translator import GoogleTranslator
+
+try:
+    import langid  # optional: lets blocks already in the target language skip the network
+except ImportError:
+    langid = None
 
 # -----------------------------
 # Step 1: Extract text blocks
 # -----------------------------
+FILL_INSET = 0.5
+# PyMuPDF's "blocks" defaults minus TEXT_PRESERVE_LIGATURES, so ligatures
+# expand to plain letters for the translator
+TEXT_FLAGS = fitz.TEXTFLAGS_BLOCKS & ~fitz.TEXT_PRESERVE_LIGATURES
+
+
+def make_block(x0, y0, x1, y1, text):
+    """Block dict with its text rect and the slightly larger rect painted over the original."""
+    return {
+        "rect": fitz.Rect(x0, y0, x1, y1),
+        "fill_rect": fitz.Rect(x0 - FILL_INSET, y0 - FILL_INSET, x1 + FILL_INSET, y1 + FILL_INSET),
+        "text": text,
+    }
+
+
+def extract_page_blocks(page):
+    """Extract text blocks of one page with coordinates."""
+    # block format: (x0, y0, x1, y1, "text", block_no, block_type, ...); type 0 is text, 1 image
+    return [
+        make_block(b[0], b[1], b[2], b[3], text)
+        for b in page.get_text("blocks", flags=TEXT_FLAGS)
+        if len(b) >= 7 and b[6] == 0 and (text := b[4].strip())
+    ]
+
+
 def extract_blocks_from_pdf(pdf_path):
     """Extract text blocks per page with coordinates."""
     doc = fitz.open(pdf_path)
-    pages_blocks = []
-
+    pages_blocks = [None] * doc.page_count
     for page in doc:
-        blocks = page.get_text("blocks")
-        page_blocks = []
-        for block in blocks:
-            # block format: (x0, y0, x1, y1, "text", block_no, block_type, ...)
-            if len(block) < 5:
-                continue
-            x0, y0, x1, y1, text = block[:5]
-            if text and str(text).strip():
-                page_blocks.append({
-                    "x0": x0, "y0": y0, "x1": x1, "y1": y1,
-                    "text": str(text).strip()
-                })
-        pages_blocks.append(page_blocks)
-
+        pages_blocks[page.number] = extract_page_blocks(page)
     doc.close()
     return pages_blocks
 
 
+# -----------------------------
+# Helper: on-disk translation cache
+# -----------------------------
+CACHE_PATH = "translation_cache.db"
+CACHE_LOOKUP_CHUNK = 500  # stay well under SQLite's bound-parameter limit
+
+_cache_conns = {}
+_cache_lock = threading.Lock()
+
+
+def cache_key(text, src="fr", dest="en"):
+    return hashlib.sha1(f"{src}|{dest}|{text}".encode("utf-8")).hexdigest()
+
+
+def get_cache_conn(cache_path=CACHE_PATH):
+    """Return the shared sqlite connection for ``cache_path``, opening it on first use."""
+    with _cache_lock:
+        conn = _cache_conns.get(cache_path)
+        if conn is None:
+            conn = sqlite3.connect(cache_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, val TEXT)")
+            _cache_conns[cache_path] = conn
+        return conn
+
+
+def cache_lookup(texts, src="fr", dest="en", cache_path=CACHE_PATH):
+    """Return {text: translation} for the texts already in the cache."""
+    if not cache_path or not texts:
+        return {}
+    conn = get_cache_conn(cache_path)
+    keyed = {cache_key(text, src, dest): text for text in texts}
+    keys = list(keyed)
+    found = {}
+    with _cache_lock:
+        for i in range(0, len(keys), CACHE_LOOKUP_CHUNK):
+            chunk = keys[i:i + CACHE_LOOKUP_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(f"SELECT key, val FROM translations WHERE key IN ({placeholders})", chunk)
+            for key, val in rows:
+                found[keyed[key]] = val
+    return found
+
+
+def cache_store(pairs, src="fr", dest="en", cache_path=CACHE_PATH):
+    """Persist (text, translation) pairs, skipping texts that got no translation (``None``)."""
+    rows = [(cache_key(text, src, dest), translated)
+            for text, translated in pairs if translated is not None]
+    if not cache_path or not rows:
+        return
+    conn = get_cache_conn(cache_path)
+    with _cache_lock, conn:
+        conn.executemany("INSERT OR REPLACE INTO translations (key, val) VALUES (?, ?)", rows)
+
+
+# -----------------------------
+# Helper: request rate limiting
+# -----------------------------
+RATE_LIMIT = 5  # Google's documented per-user limit, requests per second
+
+
+class RateLimiter:
+    """Async token bucket: at most ``rate`` requests per ``period`` seconds and
+    ``max_in_flight`` concurrent requests. Use as ``async with limiter:``."""
+
+    def __init__(self, rate=RATE_LIMIT, period=1.0, max_in_flight=RATE_LIMIT):
+        self.rate = rate
+        self.period = period
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+
+    async def acquire(self):
+        await self._in_flight.acquire()
+        try:
+            async with self._lock:
+                while True:
+                    now = time.monotonic()
+                    self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate / self.period)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    await asyncio.sleep((1 - self._tokens) * self.period / self.rate)
+        except BaseException:  # e.g. cancelled while waiting: __aexit__ won't run, give the slot back
+            self._in_flight.release()
+            raise
+
+    def release(self):
+        self._in_flight.release()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+
 # -----------------------------
 # Helper: translate single block with retry/backoff
 # -----------------------------
-def translate_with_retry(text, src="fr", dest="en", retries=3, sleep_between=0.5):
-    if not text:
-        return ""
-    if not isinstance(text, str):
-        text = str(text)
+TRANSLATE_URL = "https://translate.googleapis.com/translate_a/single"
+REQUEST_TIMEOUT = 30
+MAX_KEEPALIVE_CONNECTIONS = 20
+
 
+async def request_translation(client, text, src="fr", dest="en"):
+    """Send one text to Google's translate endpoint and return the joined result."""
+    params = {"client": "gtx", "sl": src, "tl": dest, "dt": "t"}
+    # POST keeps ~4500-char packs out of the URL
+    resp = await client.post(TRANSLATE_URL, params=params, data={"q": text})
+    resp.raise_for_status()
+    data = resp.json()
+    return "".join(segment[0] for segment in (data[0] or []) if segment and segment[0])
+
+
+async def fetch_with_retry(client, limiter, text, src="fr", dest="en", retries=3, sleep_between=0.5):
+    """Request a translation with retry/backoff; raises once retries are exhausted.
+
+    Backoff (e.g. on HTTP 429) only delays this request; the limiter slot is
+    released while sleeping so other requests keep flowing.
+    """
     for attempt in range(1, retries + 1):
         try:
-            translator = GoogleTranslator(source=src, target=dest)
-            translated = translator.translate(text)
-            if not translated:  # sometimes returns None
-                return text
-            return translated
+            async with limiter:
+                return await request_translation(client, text, src=src, dest=dest)
         except Exception as e:
             if attempt == retries:
-                print(f"   ⚠️ translate error (give up): {e}")
-                return text
+                raise
+            backoff = sleep_between * (2 ** (attempt - 1))
+            print(f"   ⚠️ translate error (attempt {attempt}) - retrying in {backoff:.1f}s: {e}")
+            await asyncio.sleep(backoff)
+
+
+async def translate_one(client, limiter, text, src="fr", dest="en", retries=3, sleep_between=0.5):
+    """Translate one text; returns ``None`` when no translation could be obtained."""
+    if not text:
+        return ""
+    if not isinstance(text, str):
+        text = str(text)
+
+    try:
+        translated = await fetch_with_retry(client, limiter, text, src=src, dest=dest,
+                                            retries=retries, sleep_between=sleep_between)
+    except Exception as e:
+        print(f"   ⚠️ translate error (give up): {e}")
+        return None
+    return translated or None
+
+
+# -----------------------------
+# Helper: skip blocks that would come back unchanged
+# -----------------------------
+SKIP_RE = re.compile(r"^[\W\d_]+$")  # numbers, punctuation, dimensions like "12.5" or "-"
+LANGID_MIN_CHARS = 20  # shorter texts are too unreliable to classify
+
+
+def needs_translation(text, dest="en"):
+    """False for texts that are only numbers/punctuation or are already in ``dest``."""
+    if SKIP_RE.match(text):
+        return False
+    if langid is not None and len(text) > LANGID_MIN_CHARS:
+        return langid.classify(text)[0] != dest
+    return True
+
+
+# -----------------------------
+# Helper: pack blocks into multi-item requests
+# -----------------------------
+BATCH_MARK = "\u241e"
+BATCH_SEP = f"\n{BATCH_MARK}\n"
+BATCH_MAX_CHARS = 4500  # Google recommends staying under 5000 chars per request
+BATCH_MAX_ITEMS = 50
+
+
+def pack_texts(texts, max_chars=BATCH_MAX_CHARS, max_items=BATCH_MAX_ITEMS):
+    """Greedily group texts into packs sent as one request."""
+    packs = []
+    current = []
+    size = 0
+    for text in texts:
+        text_len = len(text)
+        if current and (size + len(BATCH_SEP) + text_len > max_chars or len(current) >= max_items):
+            packs.append(current)
+            current = []
+            size = 0
+        size += text_len + (len(BATCH_SEP) if current else 0)
+        current.append(text)
+    if current:
+        packs.append(current)
+    return packs
+
+
+async def translate_pack(client, limiter, texts, src="fr", dest="en", retries=3, sleep_between=0.5):
+    """Translate a pack of texts in a single request, falling back to per-item calls.
+
+    Texts that could not be translated come back as ``None``.
+    """
+    if len(texts) == 1:
+        return [await translate_one(client, limiter, texts[0], src=src, dest=dest,
+                                    retries=retries, sleep_between=sleep_between)]
+
+    try:
+        translated = await fetch_with_retry(client, limiter, BATCH_SEP.join(texts), src=src, dest=dest,
+                                            retries=retries, sleep_between=sleep_between)
+    except Exception as e:
+        print(f"   ⚠️ batch translate error (give up) - falling back to per-block: {e}")
+    else:
+        parts = [part.strip() for part in translated.split(BATCH_MARK)]
+        if len(parts) == len(texts):
+            return [part or None for part in parts]
+        print(f"   ⚠️ batch split mismatch ({len(parts)} != {len(texts)}) - falling back to per-block")
+
+    return list(await asyncio.gather(*(
+        translate_one(client, limiter, text, src=src, dest=dest,
+                      retries=retries, sleep_between=sleep_between)
+        for text in texts
+    )))
+
+
+MIN_LOOKAHEAD_PAGES = 20
+
+
+async def stream_translated_pages(pages, src="fr", dest="en", workers=RATE_LIMIT, rate_limit=RATE_LIMIT,
+                                  cache_path=CACHE_PATH, batch_chars=BATCH_MAX_CHARS, lookahead=None):
+    """Translate ``(p_idx, blocks)`` pages, yielding ``(p_idx, translated_blocks)`` as each completes.
+
+    ``pages`` is consumed lazily with at most ``lookahead`` pages in progress,
+    so a page can be rewritten and released while later ones are translating.
+    Texts from every page in progress share one queue: full packs are sent at
+    once, and the last partial pack only when no request is in flight, so
+    pages with few blocks still share requests. Each unique text is
+    translated once per run and cached in ``cache_path``; to make that hold
+    across the whole document, the ``translations`` map of every unique text
+    is kept for the run, so memory is bounded by the window of block lists
+    plus the document's unique strings, not by the window alone.
+    """
+    lookahead = lookahead or max(2 * workers, MIN_LOOKAHEAD_PAGES)
+    translations = {}
+    in_flight = {}  # text -> future, for texts queued or being translated
+    queue = []  # texts waiting to be packed
+    send_tasks = set()
+    loop = asyncio.get_running_loop()
+    limiter = RateLimiter(rate=rate_limit, max_in_flight=workers)
+    limits = httpx.Limits(max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS)
+
+    # one HTTP/2 connection multiplexes every concurrent request of the run
+    async with httpx.AsyncClient(http2=True, timeout=REQUEST_TIMEOUT, limits=limits) as client:
+        async def send_pack(pack):
+            translated = await translate_pack(client, limiter, pack, src=src, dest=dest)
+            cache_store(zip(pack, translated), src=src, dest=dest, cache_path=cache_path)
+            for text, translated_text in zip(pack, translated):
+                if translated_text is None:  # give-up: keep the original text this run
+                    translated_text = text
+                translations[text] = translated_text
+                in_flight.pop(text).set_result(translated_text)
+
+        def flush(partial=False):
+            packs = pack_texts(queue, max_chars=batch_chars)
+            if packs and not partial:
+                queue[:] = packs.pop()  # keep the last, possibly partial, pack for more texts
             else:
-                backoff = sleep_between * (2 ** (attempt - 1))
-                print(f"   ⚠️ translate error (attempt {attempt}) - retrying in {backoff:.1f}s: {e}")
-                time.sleep(backoff)
-    return text
+                queue.clear()
+            for pack in packs:
+                send_tasks.add(asyncio.ensure_future(send_pack(pack)))
+
+        async def translate_page(p_idx, blocks):
+            texts = list(dict.fromkeys(block["text"] for block in blocks))
+            new = [text for text in texts if text not in translations and text not in in_flight]
+            translations.update((text, text) for text in new if not needs_translation(text, dest))
+            missing = [text for text in new if text not in translations]
+            cached = cache_lookup(missing, src=src, dest=dest, cache_path=cache_path)
+            translations.update(cached)
+            pending = [text for text in missing if text not in cached]
+            for text in pending:
+                in_flight[text] = loop.create_future()
+            queue.extend(pending)
+            flush()
+
+            for text in texts:
+                if text not in translations:
+                    await in_flight[text]
+
+            print(f"   ✅ Translated page {p_idx + 1}: {len(blocks)} blocks, {len(pending)} new texts queued")
+            return p_idx, [{**block, "text": translations[block["text"]] or ""} for block in blocks]
+
+        pages = iter(pages)
+        page_tasks = set()
+        exhausted = False
+        while True:
+            while not exhausted and len(page_tasks) < lookahead:
+                page = next(pages, None)
+                if page is None:
+                    exhausted = True
+                else:
+                    page_tasks.add(asyncio.ensure_future(translate_page(*page)))
+            await asyncio.sleep(0)  # let newly scheduled pages queue their texts
+            if queue and not send_tasks:
+                flush(partial=True)
+            if not page_tasks:
+                break
+            done, _ = await asyncio.wait(page_tasks | send_tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                result = task.result()  # re-raises failures instead of leaving pages waiting
+                if task in send_tasks:
+                    send_tasks.discard(task)
+                else:
+                    page_tasks.discard(task)
+                    yield result
 
 
 # -----------------------------
 # Step 2: Translate all blocks (concurrent)
 # -----------------------------
-def translate_blocks_deep(pages_blocks, src="fr", dest="en", workers=4, pause_between_calls=0.02):
-    """Translate all text blocks using deep-translator concurrently."""
-    tasks = []
-    for p_idx, page_blocks in enumerate(pages_blocks):
-        for b_idx, block in enumerate(page_blocks):
-            tasks.append((p_idx, b_idx, block["text"]))
-
-    translated_map = {}
-
-    def worker(task):
-        p_idx, b_idx, text = task
-        if pause_between_calls:
-            time.sleep(pause_between_calls)
-        translated = translate_with_retry(text, src=src, dest=dest)
-        return (p_idx, b_idx, translated)
-
-    print(f"🔁 Submitting {len(tasks)} blocks for translation with {workers} workers...")
-    with ThreadPoolExecutor(max_workers=workers) as exc:
-        futures = {exc.submit(worker, t): t for t in tasks}
-        completed = 0
-        for fut in as_completed(futures):
-            p_idx, b_idx, translated_text = fut.result()
-            translated_map[(p_idx, b_idx)] = translated_text
-            completed += 1
-            if completed % 50 == 0 or completed == len(tasks):
-                print(f"   ✅ Translated {completed}/{len(tasks)} blocks")
-
-    translated_pages = []
-    for p_idx, page_blocks in enumerate(pages_blocks):
-        translated_page_blocks = []
-        for b_idx, block in enumerate(page_blocks):
-            new_text = translated_map.get((p_idx, b_idx), block["text"])
-            translated_page_blocks.append({
-                "x0": block["x0"],
-                "y0": block["y0"],
-                "x1": block["x1"],
-                "y1": block["y1"],
-                "text": new_text if new_text else ""
-            })
-        translated_pages.append(translated_page_blocks)
-
-    return translated_pages
+def translate_blocks_deep(pages_blocks, src="fr", dest="en", workers=RATE_LIMIT, rate_limit=RATE_LIMIT,
+                          cache_path=CACHE_PATH, batch_chars=BATCH_MAX_CHARS):
+    """Translate all text blocks with Google Translate concurrently, in packed requests.
+
+    Identical texts are translated once, and results are persisted to
+    ``cache_path`` so reruns skip the network (pass ``None`` to disable).
+    """
+    async def collect():
+        translated_pages = [None] * len(pages_blocks)
+        async for p_idx, blocks in stream_translated_pages(enumerate(pages_blocks), src=src, dest=dest,
+                                                           workers=workers, rate_limit=rate_limit,
+                                                           cache_path=cache_path, batch_chars=batch_chars):
+            translated_pages[p_idx] = blocks
+        return translated_pages
+
+    return asyncio.run(collect())
 
 
 # -----------------------------
 # Helper: insert textbox with font-fit
 # -----------------------------
+@functools.lru_cache(maxsize=4096)
+def text_length(text, fontname="helv"):
+    """Width of ``text`` at fontsize 1; widths scale linearly with fontsize."""
+    return fitz.get_text_length(text, fontname=fontname, fontsize=1)
+
+
+def estimate_lines(text, rect_w, fontname="helv", fontsize=10):
+    """Lower bound on the wrapped lines ``text`` needs in a box ``rect_w`` wide (ignores word breaks)."""
+    return sum(max(1, math.ceil(text_length(line, fontname) * fontsize / rect_w))
+               for line in text.splitlines())
+
+
 def insert_textbox_fitted(page, rect, text, fontname="helv",
                           initial_fontsize=10, min_fontsize=6,
                           line_spacing_mult=1.15):
@@ -125,68 +423,323 @@ def insert_textbox_fitted(page, rect, text, fontname="helv",
 
     rect_w = rect.width
     rect_h = rect.height
-    fontsize = initial_fontsize
-
-    while fontsize >= min_fontsize:
-        est_chars_per_line = max(20, int(rect_w / (fontsize * 0.5)))
-        total_chars = len(text)
-        estimated_lines = math.ceil(total_chars / est_chars_per_line)
-        needed_height = estimated_lines * fontsize * line_spacing_mult
-
-        if needed_height <= rect_h or fontsize == min_fontsize:
-            try:
-                page.insert_textbox(rect, text, fontsize=fontsize, fontname=fontname, align=0)
-            except Exception:
-                page.insert_textbox(rect, text, fontsize=min_fontsize, fontname=fontname, align=0)
-            return
+    fontsize = min_fontsize
+
+    # binary-search an upper bound: the largest size the (optimistic) estimate accepts
+    lo, hi = min_fontsize, initial_fontsize
+    while rect_w > 0 and lo <= hi:
+        mid = (lo + hi) // 2
+        needed_height = estimate_lines(text, rect_w, fontname, mid) * mid * line_spacing_mult
+        if needed_height <= rect_h:
+            fontsize = mid
+            lo = mid + 1
         else:
-            fontsize -= 1
+            hi = mid - 1
 
-    page.insert_textbox(rect, text, fontsize=min_fontsize, fontname=fontname, align=0)
+    # insert_textbox writes nothing and returns < 0 when the text overflows, so
+    # step down from the estimate until MuPDF's real layout accepts it
+    while fontsize >= min_fontsize:
+        try:
+            if page.insert_textbox(rect, text, fontsize=fontsize, fontname=fontname, align=0) >= 0:
+                return
+        except Exception:
+            pass
+        fontsize -= 1
 
 
 # -----------------------------
 # Step 3: Replace translated blocks in the PDF
 # -----------------------------
+WHITE = (1, 1, 1)
+SAVE_OPTIONS = {"garbage": 4, "deflate": True, "deflate_images": True, "clean": True}
+
+
+def is_source_file(doc, path):
+    """True when ``path`` names the file ``doc`` was opened from (following links)."""
+    if not doc.name:
+        return False
+    if os.path.exists(path) and os.path.exists(doc.name):
+        return os.path.samefile(path, doc.name)
+    return os.path.abspath(path) == os.path.abspath(doc.name)
+
+
+def save_target(doc, output_pdf):
+    """Path to save ``doc`` to for ``output_pdf``.
+
+    Overwriting the input is done incrementally. When MuPDF can't (e.g. it
+    repaired the file on open), a full copy is written to a temp file beside
+    the input instead, and ``finish_save`` moves it over once ``doc`` is closed.
+    """
+    if is_source_file(doc, output_pdf) and not doc.can_save_incrementally():
+        fd, tmp_path = tempfile.mkstemp(suffix=".pdf", dir=os.path.dirname(os.path.realpath(output_pdf)))
+        os.close(fd)
+        return tmp_path
+    return output_pdf
+
+
+def finish_save(save_path, output_pdf):
+    if save_path != output_pdf:
+        os.replace(save_path, os.path.realpath(output_pdf))
+
+
+def discard_save(save_path, output_pdf):
+    if save_path != output_pdf and os.path.exists(save_path):
+        os.remove(save_path)
+
+
+def save_pdf(doc, output_pdf):
+    """Append only the changes when overwriting the document's own file, else write it compacted."""
+    if is_source_file(doc, output_pdf):
+        # PyMuPDF requires exactly doc.name for incremental saves, not just the same file
+        doc.save(doc.name, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+    else:
+        doc.save(output_pdf, **SAVE_OPTIONS)
+
+
+def replace_page_blocks(page, blocks):
+    """Cover each original block and write its translated text in place."""
+    # one shape for all covers: a single path and content-stream commit per page
+    shape = page.new_shape()
+    for block in blocks:
+        shape.draw_rect(block["fill_rect"])
+    shape.finish(color=WHITE, fill=WHITE)
+    shape.commit()
+
+    # text goes in afterwards so it always sits above the covers
+    for block in blocks:
+        insert_textbox_fitted(page, block["rect"], block["text"], initial_fontsize=10, min_fontsize=6)
+
+
 def replace_blocks_in_pdf(input_pdf, translated_pages, output_pdf):
     """Replace block texts in same positions while keeping layout/images."""
     doc = fitz.open(input_pdf)
 
     for page_num, page in enumerate(doc):
-        if page_num >= len(translated_pages):
+        if page_num >= len(translated_pages) or not translated_pages[page_num]:
             continue
-        for block in translated_pages[page_num]:
-            rect = fitz.Rect(block["x0"], block["y0"], block["x1"], block["y1"])
-            new_text = block["text"]
+        replace_page_blocks(page, translated_pages[page_num])
 
-            inset = 0.5
-            fill_rect = fitz.Rect(block["x0"] - inset, block["y0"] - inset,
-                                  block["x1"] + inset, block["y1"] + inset)
-            page.draw_rect(fill_rect, color=(1, 1, 1), fill=(1, 1, 1))
+    save_path = save_target(doc, output_pdf)
+    try:
+        save_pdf(doc, save_path)
+    except BaseException:
+        discard_save(save_path, output_pdf)
+        raise
+    finally:
+        doc.close()
+    finish_save(save_path, output_pdf)
 
-            insert_textbox_fitted(page, rect, new_text, initial_fontsize=10, min_fontsize=6)
 
-    doc.save(output_pdf)
-    doc.close()
+# -----------------------------
+# Step 3b: Replace blocks with page ranges rendered in parallel processes
+# -----------------------------
+PARALLEL_RENDER_MIN_PAGES = 20
+MIN_PAGES_PER_RENDER_PROCESS = 10  # every process re-parses the whole input
+
+
+def _chunk_job(input_pdf, page_numbers, chunk_pages, out_path):
+    """Pool job for one page range; rects travel as plain tuples and are rebuilt by the worker."""
+    packed_pages = [[(tuple(block["rect"]), block["text"]) for block in blocks] for blocks in chunk_pages]
+    return input_pdf, list(page_numbers), packed_pages, out_path
+
+
+def _render_chunk(job):
+    """Pool worker: rewrite one page range of the input and save it as its own PDF."""
+    input_pdf, page_numbers, packed_pages, out_path = job
+    doc = fitz.open(input_pdf)
+    try:
+        doc.select(page_numbers)
+        for page, packed_blocks in zip(doc, packed_pages):
+            if packed_blocks:
+                replace_page_blocks(page, [make_block(*rect, text) for rect, text in packed_blocks])
+        doc.save(out_path)  # temporary part: compaction happens once, on the merged output
+    finally:
+        doc.close()
+    return out_path
+
+
+def chunk_page_ranges(page_count, processes):
+    """Split ``range(page_count)`` into at most ``processes`` contiguous ranges."""
+    chunk_size = max(1, math.ceil(page_count / processes))
+    return [range(start, min(start + chunk_size, page_count))
+            for start in range(0, page_count, chunk_size)]
+
+
+def render_process_count(page_count, processes=None):
+    """Processes to render ``page_count`` pages with, leaving each a worthwhile share of pages."""
+    processes = processes or os.cpu_count() or 1
+    return max(1, min(processes, page_count // MIN_PAGES_PER_RENDER_PROCESS))
+
+
+def merge_pdf_chunks(chunk_paths, output_pdf, source_doc):
+    """Concatenate rendered page ranges and restore what the split dropped from ``source_doc``.
+
+    select() + insert_pdf() into a new document lose links that point into
+    another range and catalog-level data, so links, metadata, the TOC, page
+    labels and embedded files are copied back from the source. Other catalog
+    entries (e.g. named destinations) are not carried over.
+    """
+    merged = fitz.open()
+    try:
+        for path in chunk_paths:
+            part = fitz.open(path)
+            merged.insert_pdf(part)
+            part.close()
+        for page, source_page in zip(merged, source_doc):
+            for link in page.get_links():
+                page.delete_link(link)
+            for link in source_page.get_links():
+                page.insert_link(link)
+        if source_doc.metadata:
+            merged.set_metadata(source_doc.metadata)
+        toc = source_doc.get_toc(simple=False)
+        if toc:
+            merged.set_toc(toc)
+        labels = source_doc.get_page_labels()
+        if labels:
+            merged.set_page_labels(labels)
+        for name in source_doc.embfile_names():
+            info = source_doc.embfile_info(name)
+            merged.embfile_add(name, source_doc.embfile_get(name), filename=info.get("filename"),
+                               ufilename=info.get("ufilename"), desc=info.get("desc"))
+        save_pdf(merged, output_pdf)
+    finally:
+        merged.close()
+
+
+# -----------------------------
+# Pipeline: extract, translate and replace on one open document
+# -----------------------------
+def iter_page_blocks(doc):
+    """Lazily yield ``(page_number, blocks)`` for every page of ``doc``."""
+    for page in doc:
+        yield page.number, extract_page_blocks(page)
+
+
+async def replace_pages_streaming(doc, **translate_kwargs):
+    """Rewrite each page of ``doc`` as soon as its translations land."""
+    async for p_idx, blocks in stream_translated_pages(iter_page_blocks(doc), **translate_kwargs):
+        if blocks:
+            replace_page_blocks(doc[p_idx], blocks)
+
+
+async def render_pages_streaming_parallel(doc, input_pdf, output_pdf, processes=None,
+                                          **translate_kwargs):
+    """Hand each page range to a render process as soon as all its pages are translated.
+
+    Translated blocks are buffered until their whole range is complete, so up
+    to a range's worth of pages (``1/len(ranges)`` of the document) is held.
+    """
+    ranges = chunk_page_ranges(doc.page_count, render_process_count(doc.page_count, processes))
+    chunk_index = {p_idx: i for i, pages in enumerate(ranges) for p_idx in pages}
+    buffers = [{} for _ in ranges]
+    pending_jobs = [None] * len(ranges)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with multiprocessing.Pool(processes=len(ranges)) as pool:
+            async for p_idx, blocks in stream_translated_pages(iter_page_blocks(doc), **translate_kwargs):
+                i = chunk_index[p_idx]
+                buffers[i][p_idx] = blocks
+                if len(buffers[i]) == len(ranges[i]):
+                    chunk_pages = [buffers[i][p] for p in ranges[i]]
+                    buffers[i] = None
+                    job = _chunk_job(input_pdf, ranges[i], chunk_pages, os.path.join(tmp_dir, f"chunk_{i}.pdf"))
+                    pending_jobs[i] = pool.apply_async(_render_chunk, (job,))
+            chunk_paths = [job.get() for job in pending_jobs]
+        merge_pdf_chunks(chunk_paths, output_pdf, doc)
+
+
+def translate_pdf(input_pdf, output_pdf, src="fr", dest="en", workers=RATE_LIMIT,
+                  rate_limit=RATE_LIMIT, cache_path=CACHE_PATH, batch_chars=BATCH_MAX_CHARS,
+                  parallel_render=False):
+    """Translate a PDF in place of its text blocks, parsing the input only once.
+
+    Extraction, translation and rewriting are streamed page by page, so block
+    lists are only held for a window of pages (a whole page range on the
+    parallel path) and rewriting starts before the last page is translated.
+    The translated strings themselves are kept for the run to deduplicate
+    repeated texts. Overwriting the input takes the in-place path with an
+    incremental save; if MuPDF can't save incrementally (e.g. a repaired
+    file), that is detected before translating and a full copy replaces the
+    input once it is closed.
+
+    ``parallel_render`` opts documents over 20 pages into multi-process
+    rendering; it rebuilds the file, so catalog entries beyond those restored
+    by ``merge_pdf_chunks`` are lost.
+    """
+    translate_kwargs = {"src": src, "dest": dest, "workers": workers, "rate_limit": rate_limit,
+                        "cache_path": cache_path, "batch_chars": batch_chars}
+    doc = fitz.open(input_pdf)
+    save_path = save_target(doc, output_pdf)
+    try:
+        print(f"📄 {doc.page_count} pages - translating blocks with Google Translate "
+              "and replacing text while preserving layout...")
+        if (parallel_render and doc.page_count > PARALLEL_RENDER_MIN_PAGES
+                and render_process_count(doc.page_count) > 1 and not is_source_file(doc, save_path)):
+            asyncio.run(render_pages_streaming_parallel(doc, input_pdf, save_path, **translate_kwargs))
+        else:
+            asyncio.run(replace_pages_streaming(doc, **translate_kwargs))
+            save_pdf(doc, save_path)
+    except BaseException:
+        discard_save(save_path, output_pdf)
+        raise
+    finally:
+        doc.close()
+    finish_save(save_path, output_pdf)
 
 
 # -----------------------------
 # Step 4: Run Workflow
 # -----------------------------
-if __name__ == "__main__":
-    input_pdf = "1_LATEST STRUCT UPTO (DIR S-03).pdf"
-    output_pdf = "replaced_deep_translated.pdf"
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"expected a positive integer, got {value!r}")
+    return number
+
+
+def env_positive_int(parser, name, default):
+    """Read a positive int from environment variable ``name``, reporting bad values via ``parser``."""
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return positive_int(value)
+    except argparse.ArgumentTypeError as e:
+        parser.error(f"{name}: {e}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Translate a PDF while preserving its layout.")
+    default_workers = env_positive_int(parser, "TRANSLATE_WORKERS", min(32, (os.cpu_count() or 4) + 4))
+    default_batch_chars = env_positive_int(parser, "TRANSLATE_BATCH_CHARS", BATCH_MAX_CHARS)
+
+    parser.add_argument("input_pdf", nargs="?", default="1_LATEST STRUCT UPTO (DIR S-03).pdf")
+    parser.add_argument("output_pdf", nargs="?", default="replaced_deep_translated.pdf")
+    parser.add_argument("--src", default="fr", help="source language code (default: fr)")
+    parser.add_argument("--dest", default="en", help="target language code (default: en)")
+    parser.add_argument("--workers", type=positive_int, default=default_workers,
+                        help="max concurrent requests (env TRANSLATE_WORKERS, default: %(default)s)")
+    parser.add_argument("--batch-size", dest="batch_chars", type=positive_int, default=default_batch_chars, metavar="CHARS",
+                        help="max chars packed into one request (env TRANSLATE_BATCH_CHARS, "
+                             "default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help=f"don't read or write the {CACHE_PATH} translation cache")
+    parser.add_argument("--parallel-render", action="store_true",
+                        help=f"render documents over {PARALLEL_RENDER_MIN_PAGES} pages in several processes "
+                             "(rebuilds the file; may drop named destinations and other catalog data)")
+    return parser.parse_args(argv)
 
-    print("📄 Extracting text blocks...")
-    pages_blocks = extract_blocks_from_pdf(input_pdf)
-    total_blocks = sum(len(p) for p in pages_blocks)
-    print(f"   → Found {len(pages_blocks)} pages and {total_blocks} text blocks")
 
-    print("🌍 Translating blocks with deep-translator (Google)...")
-    translated_pages = translate_blocks_deep(pages_blocks, src="fr", dest="en",
-                                             workers=4, pause_between_calls=0.02)
+if __name__ == "__main__":
+    args = parse_args()
 
-    print("📝 Replacing text while preserving layout...")
-    replace_blocks_in_pdf(input_pdf, translated_pages, output_pdf)
+    translate_pdf(args.input_pdf, args.output_pdf, src=args.src, dest=args.dest,
+                  workers=args.workers, rate_limit=RATE_LIMIT,
+                  cache_path=None if args.no_cache else CACHE_PATH,
+                  batch_chars=args.batch_chars, parallel_render=args.parallel_render)
 
-    print("✅ Done! File created:", output_pdf)
+    print("✅ Done! File created:", args.output_pdf)